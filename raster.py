@@ -15,18 +15,26 @@ projection. The dataset contains population values in a 1km x 1km grid.
 
 # %%
 # imports
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import rasterio as rio
+import rioxarray  # noqa: F401
+import shapely
 import xarray as xr
 
-from geocube.vector import vectorize
+from numba import njit, prange
+from pyproj import CRS, Transformer
 from pyprojroot import here
-from rasterio.mask import raster_geometry_mask
-from shapely import box
+from rasterio.enums import Resampling
+from rasterio.features import shapes
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds
+from zarr.codecs import BloscCodec
 
 # %% [markdown] noqa: D212, D400, D415
 """
@@ -35,13 +43,28 @@ representing some information. A file may contain several layers, each
 representing different information.
 
 A Python package useful to process raster files is called `rasterio`.
+
+`rasterio` uses the GDAL library to read and write files, and some of its
+settings can be changed with environment variables before opening a file.
+Here we give GDAL a larger cache (in MB), so the parts of the file that have
+already been decoded stay in memory for the next reads, and let it use all
+available cores to decompress the data.
 """
 
 # %%
-# read raster file
+# GDAL settings. The last one only matters when reading files from a URL
+os.environ["GDAL_CACHEMAX"] = "512"
+os.environ["GDAL_NUM_THREADS"] = "ALL_CPUS"
+os.environ["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"] = ".tif"
+
+# read raster file. Each opened dataset is only used by one thread, so GDAL
+# doesn't need to share the file handle between them
 path = here("data")
 dataset = rio.open(
-    os.path.join(path, "GHS_POP_E2020_GLOBE_R2023A_54009_1000_V1_0_R3_C18.tif")
+    os.path.join(
+        path, "GHS_POP_E2020_GLOBE_R2023A_54009_1000_V1_0_R3_C18.tif"
+    ),
+    sharing=False,
 )
 
 # %% [markdown] noqa: D212, D400, D415
@@ -98,14 +121,65 @@ attribute `nodata`.
 <br>
 <br>
 If we want to plot its contents, we can use matplotlib `imshow` function.
+A figure can only show a limited number of pixels, so for large rasters we
+can plot only every n-th row and column, which is much faster to draw and
+looks the same.
+<br>
+<br>
+By default, `.read` creates a new array every time it is called. If we
+already have an array of the right shape and type, we can pass it with the
+`out` argument and the values will be written into it instead, which saves
+memory when reading several bands or files of the same size.
+<br>
+<br>
+Raster files are usually stored internally in blocks (tiles or strips),
+which can be read independently. For large rasters, we can read several
+blocks at the same time using threads, writing each one into its place in
+the `band` array with `out`. `rasterio` datasets can't be shared between
+threads, so each thread opens the file on its own.
+<br>
+<br>
+GDAL can also decompress several blocks at once by itself, within a single
+`.read` call, using the `GDAL_NUM_THREADS` setting we gave it above. Both
+approaches use all cores, so with that setting a plain
+`dataset.read(1, out=band)` can be just as fast. The thread pool mostly pays
+off when GDAL can't decode the file in parallel by itself (e.g. for some
+formats or compressions), at the cost of one open file per thread.
 
 """
 # %%
-band = dataset.read(1)
+band = np.empty((dataset.height, dataset.width), dtype=dataset.dtypes[0])
+
+# split the blocks of the band between the threads, one per core. Each
+# thread opens the file, so we never start more threads than there are
+# blocks to read
+blocks = [window for _, window in dataset.block_windows(1)]
+n_threads = min(os.cpu_count() or 1, len(blocks))
+blocks_per_thread = [blocks[i::n_threads] for i in range(n_threads)]
+
+
+def read_blocks(windows):
+    """Read the given blocks of the first band into `band`."""
+    with rio.open(dataset.name, sharing=False) as src:
+        for window in windows:
+            rows, cols = window.toslices()
+            src.read(1, window=window, out=band[rows, cols])
+
+
+with ThreadPoolExecutor(max_workers=n_threads) as executor:
+    list(executor.map(read_blocks, blocks_per_thread))
+
 print(band)
 print(type(band))
 
-plt.imshow(band)
+
+def preview(array, target=1024):
+    """Subsample `array` so that its longest side has about `target` cells."""
+    step = max(1, max(array.shape) // target)
+    return array[::step, ::step]
+
+
+plt.imshow(preview(band))
 
 # %% [markdown] noqa: D212, D400, D415
 """
@@ -113,28 +187,107 @@ It is also possible to read a specific chunk of a band (e.g. whatever falls
 within a specific bounding box).
 <br>
 <br>
-To do this, we can use the method `raster_geometry_mask`, which will return
-a mask array with values False in the positions that fall within the limits,
-or True otherwise. If giving the argument `crop=True`, it will return only
-the cells within the box, and a `Window` object with the col and row limits
-of the crop provided. We can use this window as an argument when reading a
-layer.
+The bounding box is usually given in latitude and longitude (`EPSG: 4326`),
+so first we need to reproject its corners to the CRS of the raster. A
+`Transformer` from `pyproj` can do this for several points at once.
+<br>
+<br>
+Then, we can use the function `from_bounds`, which uses the affine
+transform of the dataset to convert the limits of the box into a `Window`
+object with the col and row limits of the crop. The limits will usually fall
+in the middle of a cell, so we round them outwards to keep every cell that
+the box touches, and we intersect the result with the full extent of the
+dataset in case the box goes beyond it. We can use this window as an
+argument when reading a layer, and the method `window_transform` gives us
+the affine transform of the cropped area. We put these steps in a function,
+as we will use them again below.
 
 """
 
 # %%
+# parse the CRSs once, so they can be reused without looking them up again
+latlon_crs = CRS.from_epsg(4326)
+mollweide_crs = CRS.from_user_input("ESRI: 54009")
+
 # bbox around the Bristol channel
 bbox = [-3.6955, 51.1869, -2.3002, 51.9855]
-bbox_gdf = gpd.GeoDataFrame(geometry=[box(*bbox)], crs="EPSG: 4326").to_crs(
-    "ESRI: 54009"
+
+# reproject the four corners of the bbox to the CRS of the raster
+transformer = Transformer.from_crs(latlon_crs, mollweide_crs, always_xy=True)
+xs, ys = transformer.transform(
+    [bbox[0], bbox[2], bbox[2], bbox[0]], [bbox[1], bbox[1], bbox[3], bbox[3]]
 )
 
-_, aff, window = raster_geometry_mask(
-    dataset, bbox_gdf.geometry.values, crop=True, all_touched=True
+
+def bounds_window(src, xs, ys):
+    """Window of `src` with every cell touched by the bounds of the points."""
+    # rows and cols of the bbox limits, rounded outwards so every cell the
+    # box touches is kept, and clipped to the extent of `src`
+    (row_start, row_stop), (col_start, col_stop) = from_bounds(
+        min(xs), min(ys), max(xs), max(ys), transform=src.transform
+    ).toranges()
+    return Window.from_slices(
+        (math.floor(row_start), math.ceil(row_stop)),
+        (math.floor(col_start), math.ceil(col_stop)),
+    ).intersection(Window(0, 0, src.width, src.height))
+
+
+window = bounds_window(dataset, xs, ys)
+aff = dataset.window_transform(window)
+
+# the buffer only needs to be the size of the window
+band_cropped = np.empty((window.height, window.width), dtype=band.dtype)
+dataset.read(1, window=window, out=band_cropped)
+
+# filtering and vectorising are much faster on arrays stored as one
+# continuous block of memory. Arrays created with `np.empty` already are, so
+# this doesn't make a copy, but it's a cheap guarantee
+band_cropped = np.ascontiguousarray(band_cropped)
+assert band_cropped.flags["C_CONTIGUOUS"]
+plt.imshow(preview(band_cropped))
+
+# %% [markdown] noqa: D212, D400, D415
+"""
+A raster can also be reprojected to a different CRS. Instead of reading the
+whole band and reprojecting the array, we can open the dataset through a
+`WarpedVRT`, a virtual dataset that reprojects the data as it is read. This
+way, reading a window only reprojects the cells within it, and all the work
+is done by GDAL, which can use several threads.
+<br>
+<br>
+In the example below, we read the same bounding box reprojected to Web
+Mercator (`EPSG: 3857`), the CRS used by most web maps. Windows of the
+virtual dataset are in its own CRS, so the corners of the bbox need to be
+reprojected to Web Mercator too. We then build the window in the same way as
+before, so it keeps every cell the box touches and stays within the virtual
+dataset.
+
+"""
+
+# %%
+web_mercator_crs = CRS.from_epsg(3857)
+
+# reproject the corners of the bbox to Web Mercator
+transformer_3857 = Transformer.from_crs(
+    latlon_crs, web_mercator_crs, always_xy=True
+)
+xs_3857, ys_3857 = transformer_3857.transform(
+    [bbox[0], bbox[2], bbox[2], bbox[0]], [bbox[1], bbox[1], bbox[3], bbox[3]]
 )
 
-band_cropped = dataset.read(1, window=window)
-plt.imshow(band_cropped)
+# warp_mem_limit (in MB) lets GDAL keep more of the data in memory while
+# reprojecting
+with WarpedVRT(
+    dataset,
+    crs=web_mercator_crs,
+    resampling=Resampling.bilinear,
+    warp_mem_limit=512,
+    NUM_THREADS="ALL_CPUS",
+) as vrt:
+    window_3857 = bounds_window(vrt, xs_3857, ys_3857)
+    band_3857 = vrt.read(1, window=window_3857)
+
+plt.imshow(preview(band_3857))
 
 # %% [markdown] noqa: D212, D400, D415
 """
@@ -143,41 +296,154 @@ the data arrays. After that, the modified data can be resaved as a new raster
 file.
 <br>
 <br>
+For operations that go through every cell, like filtering, `numba` can
+compile a simple Python loop into machine code. This way, the comparison and
+the replacement of the discarded cells are done in a single pass over the
+array, and the rows are split between all available cores.
+<br>
+<br>
+The data type of the result doesn't need to be the same as the original.
+Population values per cell in the area we cropped fit in a 16 bit integer
+(up to 32,767), and so does the null value `-200`, so we can store the
+filtered band as `int16`. This uses less memory than the original type, and
+makes the saved file and any later processing of the array lighter. This
+isn't true everywhere: cells in dense cities can have more people than that,
+and storing them as `int16` would give wrong values. So we check the data
+first, and use `int32` if any value doesn't fit.
+<br>
+<br>
 To save the new raster, you will need to include some profile information, like
 the affine transform, what value to use for nulls, etc. It is possible to
-reuse the profile from the original raster, changing only the modified
-parameters.
+reuse the profile from the original raster (`dataset.profile`), changing only
+the modified parameters. However, `dataset.profile` is rebuilt from the file
+every time it is accessed, and here we are changing most of it anyway, so we
+can build the profile ourselves from the attributes we need.
+<br>
+<br>
+The profile also controls how the file is stored. Saving it in tiles and
+compressed makes the file smaller and faster to read. We can also add
+overviews, which are lower resolution copies of the raster stored in the same
+file. Programs that show the raster zoomed out can read these instead of the
+full resolution data.
 
 """
 
-# %%
-# we can select all cells with higher than 5,000  population
-mask = band_cropped > 5000
-filtered_band = np.where(mask, band_cropped, -200)
-
-# image shows only kept cells
-plt.imshow(filtered_band)
-
-# get original profile
-profile = dataset.profile
-print(profile)
 
-# modified relevant parts, in this case the affine transform and the size
-# as we have cropped the raster
-profile.update(
-    transform=aff, height=filtered_band.shape[0], width=filtered_band.shape[1]
+# %%
+@njit(parallel=True, cache=True)
+def threshold_nodata(band, threshold, nodata, out):
+    """Copy `band` into `out`, setting cells not above `threshold` to null."""
+    for i in prange(band.shape[0]):
+        for j in range(band.shape[1]):
+            out[i, j] = band[i, j] if band[i, j] > threshold else nodata
+
+
+# we can select all cells with higher than 5,000  population, setting the
+# rest to the null value. Values are truncated to whole numbers, stored as
+# int16 unless some of them are too large for it
+if band_cropped.max() <= np.iinfo(np.int16).max:
+    filtered_dtype = np.int16
+else:
+    filtered_dtype = np.int32
+filtered_band = np.empty(band_cropped.shape, dtype=filtered_dtype)
+threshold_nodata(band_cropped, 5000, -200, filtered_band)
+
+# find the kept cells once, and reuse it wherever null cells need to be
+# left out
+valid = np.empty(filtered_band.shape, dtype=bool)
+np.not_equal(filtered_band, -200, out=valid)
+
+# image shows only kept cells, with null cells left blank. We subsample
+# first, so only the cells that will be plotted are converted
+plt.imshow(np.where(preview(valid), preview(filtered_band), np.nan))
+
+# build the profile: the CRS and null value are the same as the original,
+# while the affine transform and the size change as we have cropped the
+# raster, and so does the data type of the filtered band. We also save it
+# in compressed 256x256 tiles
+profile = dict(
+    driver="GTiff",
+    dtype=filtered_band.dtype,
+    count=1,
+    crs=dataset.crs,
+    nodata=-200,
+    transform=aff,
+    height=filtered_band.shape[0],
+    width=filtered_band.shape[1],
+    tiled=True,
+    blockxsize=256,
+    blockysize=256,
+    compress="LZW",
+    predictor=2,
+    BIGTIFF="IF_SAFER",
 )
+print(profile)
 
-# now we can save our processed raster file
+# now we can save our processed raster file, adding overviews at 1/2, 1/4,
+# 1/8 and 1/16 of the resolution, averaging the cells
 with rio.open(here("data/modified_raster.tif"), "w", **profile) as w:
     w.write(filtered_band, 1)
+    w.build_overviews([2, 4, 8, 16], Resampling.average)
+    w.update_tags(ns="rio_overview", resampling="average")
 
 # %%
-# and you can read it again to check that it saved correctly
-with rio.open(here("data/modified_raster.tif")) as r:
-    d = r.read(1)
+# and you can open it again to check that it saved correctly. Opening a file
+# only reads its metadata, so we can compare it with what we wrote without
+# decoding all the data again
+assert os.path.getsize(here("data/modified_raster.tif")) > 0
+with rio.open(here("data/modified_raster.tif"), sharing=False) as r:
     print(r.profile)
-    plt.imshow(d)
+    assert r.shape == filtered_band.shape
+    assert r.dtypes[0] == filtered_band.dtype
+    assert r.transform == aff
+
+# %% [markdown] noqa: D212, D400, D415
+"""
+GeoTIFF files need to be rewritten completely every time they are modified,
+and are read mostly one block after another. If the processed data will be
+used in further analysis, it can be useful to save a copy in
+[Zarr](https://zarr.dev/) format too. Zarr stores an array as many small
+compressed chunks, so later steps can read, modify or append only the chunks
+they need, even in parallel.
+<br>
+<br>
+We can save it with `xarray`, giving names to the dimensions and adding the
+coordinates of the centre of each cell, calculated from the affine transform.
+The `.rio` accessor, from `rioxarray`, stores the CRS and transform too.
+Passing everything when creating the array, and using `inplace=True`, avoids
+making a new copy of the array at each step.
+To open it again, use `xr.open_zarr` (with `decode_coords="all"` to recover
+the CRS), which will only load the chunks needed by each operation. The store
+is saved without consolidated metadata, which isn't part of the Zarr format 3
+specification, so pass `consolidated=False` when opening it too.
+
+"""
+
+# %%
+# build an xarray with the coordinates of each cell and the null value, and
+# add the CRS and affine transform in place, without making new copies
+n_rows, n_cols = filtered_band.shape
+x_array = xr.DataArray(
+    filtered_band,
+    dims=("y", "x"),
+    coords={
+        "y": aff.f + aff.e * (np.arange(n_rows) + 0.5),
+        "x": aff.c + aff.a * (np.arange(n_cols) + 0.5),
+    },
+    attrs={"_FillValue": -200},
+    name="population",
+)
+x_array.rio.write_crs(mollweide_crs, inplace=True)
+x_array.rio.write_transform(aff, inplace=True)
+
+# save it in 512x512 chunks, compressed with zstd. These are added to the
+# existing encoding, which tells xarray where the CRS is stored
+x_array.encoding.update(
+    chunks=(512, 512), compressors=(BloscCodec(cname="zstd", clevel=3),)
+)
+x_array.to_zarr(
+    here("data/modified_raster.zarr"), mode="w", consolidated=False
+)
 
 # %% [markdown] noqa: D212, D400, D415
 """
@@ -187,28 +453,52 @@ information, but you will lose some of the functionality of the raster format
 so it's worth doing it once the raster has been processed completely.
 <br>
 <br>
-To do this, there are two further dependencies: `geocube` to vectorize, and
-`xarray`, to convert the raster to `xarray` format, which is necessary for
-`geocube`.
+To do this, we can use the function `shapes` from `rasterio.features`
+directly on the numpy array. It groups neighbouring cells with the same value
+into polygons, and uses the affine transform to place them in space. Cells
+with a null value can be left out with the `mask` argument, for which we
+reuse the array of kept cells. `shapes` returns each polygon as a
+GeoJSON-like dictionary together with its value, from which we build a
+GeoDataFrame. Instead of converting each polygon separately, we gather the
+coordinates of all of them and let `shapely` create all the geometries in one
+go, which is much faster when there are many polygons.
+<br>
+<br>
+`shapes` traces the edges between cells of different values row by row, so
+the number of polygons it creates depends on how many groups of cells there
+are. In rasters with categories (e.g. land use), small groups of cells can
+be merged into their neighbours first with `rasterio.features.sieve`, to get
+fewer and larger polygons. We don't do this here: population values are
+continuous, so almost every cell has a different value, and sieving would
+just change the population of some cells.
 
 """
 # %%
-# convert to xarray
-x_array = (
-    xr.DataArray(filtered_band)
-    .astype("int32")
-    .rio.write_nodata(-200)
-    .rio.write_transform(aff)
-    .rio.set_crs("ESRI: 54009", inplace=True)
+# vectorise! Each polygon is a list of rings (the outline and any holes),
+# and each ring a list of points. We collect all the points in one list,
+# keeping track of the ring and polygon they belong to
+coords, ring_sizes, ring_polygons, labels = [], [], [], []
+for i, (geom, label) in enumerate(
+    shapes(filtered_band, mask=valid, transform=aff)
+):
+    for ring in geom["coordinates"]:
+        coords.extend(ring)
+        ring_sizes.append(len(ring))
+        ring_polygons.append(i)
+    labels.append(label)
+
+# create all the geometries at once: first the rings, then the polygons,
+# where the first ring of each polygon is its outline. The arrays are given
+# an explicit shape and type so that this also works if no cell was kept
+rings = shapely.linearrings(
+    np.asarray(coords, dtype=float).reshape(-1, 2),
+    indices=np.repeat(np.arange(len(ring_sizes)), ring_sizes),
 )
+geoms = shapely.polygons(rings, indices=np.asarray(ring_polygons, dtype=int))
 
-# print xarray to see format
-print(x_array)
-
-# vectorise!
-gdf = vectorize(x_array)
-
-# change column names and explore
-gdf.columns = ["label", "geometry"]
+# build a GeoDataFrame and explore
+gdf = gpd.GeoDataFrame(
+    {"label": np.asarray(labels)}, geometry=geoms, crs=mollweide_crs
+)
 gdf.explore()
 # %%